@@ -23,4 +23,6 @@ for split in ['train', 'val', 'test']:
     # foo = text_embeddings_cls.reshape(len(all_cls_tokens)//5, 768)
 
     with open(ROOT_PATH + "Flickr30k/"+split+"_bert_features.pkl", 'wb') as f:
-        pickle.dump(text_embeddings_cls, f)
\ No newline at end of file
+        pickle.dump(text_embeddings_cls, f)
+    # float16 copy of the same features, opened as a memory map by the datasets (see datasets.load_embeddings)
+    np.save(ROOT_PATH + "Flickr30k/"+split+"_bert_features.npy", text_embeddings_cls.astype(np.float16))
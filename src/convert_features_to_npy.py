@@ -0,0 +1,28 @@
+"""
+File: convert_features_to_npy.py
+Authors: Juan A. Rodriguez , Igor Ugarte, Francesc Net, David Serrano
+Description:
+    This script converts the pickled test features into float16 files.
+    The image features .npy file is opened as a memory map by the Flickr30k dataset, which avoids deserializing the
+    whole pickle. Text features are stored already aggregated in a .npz file, together with the aggregation used.
+"""
+import numpy as np
+
+from datasets import Flickr30k
+
+ROOT_PATH = "../../data/"
+
+image_features = 'FasterRCNN'
+text_aggregation = 'mean'
+
+# Load the pickles once, the dataset takes care of the transposition and the text aggregation
+dataset = Flickr30k(ROOT_PATH + 'Flickr30k/test_' + image_features + '_features.pkl',
+                    ROOT_PATH + 'Flickr30k/test_fasttext_features.pkl', train=False,
+                    text_aggregation=text_aggregation)
+
+np.save(ROOT_PATH + 'Flickr30k/test_' + image_features + '_features.f16.npy',
+        dataset.image_embeddings.astype(np.float16))
+np.savez(ROOT_PATH + 'Flickr30k/test_fasttext_' + text_aggregation + '_features.f16.npz',
+         embeddings=dataset.text_embeddings.astype(np.float16), aggregation=text_aggregation)
+
+print("Image features: {}\nText features: {}".format(dataset.image_embeddings.shape, dataset.text_embeddings.shape))
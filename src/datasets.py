@@ -14,27 +14,50 @@ from PIL import Image
 from torch.utils.data import Dataset
 
 
+def load_embeddings(embedding_path):
+    """
+    Load precomputed embeddings from disk.
+    .npy files are opened as a read-only memory map, so only the rows that are used are read.
+    .npz files hold aggregated text embeddings together with their aggregation (see convert_features_to_npy.py).
+    :param embedding_path:  Path to a .pkl, .npy or .npz file.
+    :return:                Array of embeddings, or the NpzFile for .npz files.
+    """
+    if embedding_path.endswith('.npy'):
+        return np.load(embedding_path, mmap_mode='r')
+    if embedding_path.endswith('.npz'):
+        return np.load(embedding_path)
+    with open(embedding_path, 'rb') as f:
+        return pickle.load(f)
+
+
 class Flickr30k(Dataset):
     def __init__(self, image_embedding_path, text_embedding_path, train, text_aggregation='mean'):
         self.train = train
         self.text_aggregation = text_aggregation
         # Load the image embeddings
-        with open(image_embedding_path, 'rb') as f:
-            self.image_embeddings = pickle.load(f)
+        self.image_embeddings = load_embeddings(image_embedding_path)
 
         # Ugly trick to manage transposed embeddings
         if self.image_embeddings.shape[1] == 1024:
             self.image_embeddings = np.transpose(self.image_embeddings)
 
         # Load the text embeddings
-        with open(text_embedding_path, 'rb') as f:
-            self.text_embeddings = pickle.load(f)
+        self.text_embeddings = load_embeddings(text_embedding_path)
+
+        # .npz files hold already aggregated (N, 5, D) embeddings, stored with the aggregation that produced them
+        aggregated = text_embedding_path.endswith('.npz')
+        if aggregated:
+            if str(self.text_embeddings['aggregation']) != self.text_aggregation:
+                raise ValueError('{} contains {} aggregated text embeddings, not {}'.format(
+                    text_embedding_path, self.text_embeddings['aggregation'], self.text_aggregation))
+            self.text_embeddings = self.text_embeddings['embeddings']
 
         # Number of captions per image
         self.num_captions = len(self.text_embeddings[0])
 
         if self.text_aggregation is not 'BERT':
-            self.text_embeddings = self.aggregate_text_embedding(self.text_embeddings)
+            if not aggregated:
+                self.text_embeddings = self.aggregate_text_embedding(self.text_embeddings)
         else:
             self.text_embeddings = self.text_embeddings.reshape(self.text_embeddings.shape[0] // 5, 5, -1)
 
@@ -203,8 +226,7 @@ class Flickr30kEndToEnd(Dataset):
             ])
 
         # Load the text embeddings
-        with open(text_embedding_path, 'rb') as f:
-            self.text_embeddings = pickle.load(f)
+        self.text_embeddings = load_embeddings(text_embedding_path)
 
         # Number of captions per image
         self.num_captions = len(self.text_embeddings[0])
@@ -220,7 +242,8 @@ class Flickr30kEndToEnd(Dataset):
     def __getitem__(self, index):
         img = Image.open(self.root_path + '/Flickr30k/flickr30k-images/' + self.image_names[index])
         img = self.transform(img)
-        text_embedding = self.text_embeddings[index]
+        # Read only this row from the (possibly memory mapped, float16) embeddings
+        text_embedding = np.asarray(self.text_embeddings[index], dtype=np.float32)
 
         return img, text_embedding
 
@@ -247,52 +270,36 @@ class TripletFlickr30kTextToImgEndToEnd(Dataset):
         self.dataset = dataset
         self.n_samples = dataset.length_dataset
         self.train = split == 'train'
+        self.num_captions = 5
 
         if not self.train:  # Test triplets
-            # Loop to create fixed triplets for testing
-            triplets = []
-            for anchor_index in range(self.n_samples):
-                # Get anchor image and positive text embedding (random from the set of 5 texts)
-                positive_image, anchor_text = self.dataset[anchor_index]
-                # Chose only a random text from the 5
-                anchor_text = anchor_text[random.randint(0, 4)]
-                # Get index of the negative text embedding
-                negative_image_index = anchor_index
-                while negative_image_index == anchor_index:
-                    negative_image_index = np.random.choice(range(self.n_samples))
-
-                # Get negative text embedding (random from the set of 5 texts)
-                negative_image = Image.open(
-                    self.dataset.root_path + '/Flickr30k/flickr30k-images/' + self.dataset.image_names[
-                        negative_image_index])
-                negative_image = self.dataset.transform(negative_image)
+            # Fixed triplets for testing, sampled for all the anchors at once.
+            # Only the indices are stored, the images are loaded in __getitem__
+            self.test_captions = np.random.randint(0, self.num_captions, size=self.n_samples)
+            self.test_negatives = self.sample_negatives(np.arange(self.n_samples))
 
-                # Create triplet and add it to the list
-                triplets.append([anchor_text, positive_image, negative_image])
+    def sample_negatives(self, anchor_indices):
+        # Shift each anchor by a random offset in [1, n_samples), so the negative is never the anchor itself
+        offsets = np.random.randint(1, self.n_samples, size=np.shape(anchor_indices))
+        return (anchor_indices + offsets) % self.n_samples
 
-            self.test_triplets = triplets
+    def load_image(self, index):
+        image = Image.open(self.dataset.root_path + '/Flickr30k/flickr30k-images/' + self.dataset.image_names[index])
+        return self.dataset.transform(image)
 
     def __getitem__(self, index):
+        # Get anchor image and positive text embedding (from the set of 5 texts)
+        positive_image, anchor_text = self.dataset[index]
         if self.train:
-            # Get anchor image and positive text embedding (random from the set of 5 texts)
-            positive_image, anchor_text = self.dataset[index]
-            # Chose only a random text from the 5
-            anchor_text = anchor_text[random.randint(0, 4)]
-            # Get index of the negative text embedding
-            negative_image_index = index
-            while negative_image_index == index:
-                negative_image_index = np.random.choice(range(self.n_samples))
-
-            # Get negative text embedding (random from the set of 5 texts)
-            negative_image = Image.open(
-                self.dataset.root_path + '/Flickr30k/flickr30k-images/' + self.dataset.image_names[
-                    negative_image_index])
-            negative_image = self.dataset.transform(negative_image)
-
+            # Chose only a random text from the 5 and a random negative image
+            caption_index = np.random.randint(0, self.num_captions)
+            negative_image_index = self.sample_negatives(index)
         else:
-            anchor_text = self.test_triplets[index][0]
-            positive_image = self.test_triplets[index][1]
-            negative_image = self.test_triplets[index][2]
+            caption_index = self.test_captions[index]
+            negative_image_index = self.test_negatives[index]
+
+        anchor_text = anchor_text[caption_index]
+        negative_image = self.load_image(negative_image_index)
 
         return (anchor_text, positive_image, negative_image), []
 
@@ -7,50 +7,101 @@ Description:
     - Quantitative and qualitative results are presented
 """
 
+import argparse
 import json
+import os
 import os.path
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import path
 
+import matplotlib
+matplotlib.use('Agg')  # Headless backend, the figures are only saved to disk
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from sklearn.neighbors import KNeighborsClassifier
 
 from datasets import Flickr30k
 from models_v2 import ResnetFlickr, EmbeddingTextNet, TripletTextImage, EmbeddingImageNet
 from evaluation_metrics import mapk
 import faiss
-cuda = torch.cuda.is_available()
+import faiss.contrib.torch_utils  # Allows passing torch tensors to the Faiss indexes
+import simsimd
+
+# Maximum number of images for which the search is done with SimSIMD instead of Faiss
+SIMSIMD_MAX_SAMPLES = 5000
+
+
+def read_image(image_path, jpeg, pixel_format):
+    # Decode the JPEG with libjpeg-turbo, which releases the GIL so several images can be decoded in parallel
+    with open(image_path, 'rb') as f:
+        return jpeg.decode(f.read(), pixel_format=pixel_format)
+
+
+def quantize_int8(embeddings):
+    """
+    Linearly quantize each embedding to int8, scaling it so that its largest component is 127.
+    The cosine similarity does not depend on the norm, so the per-vector scales do not need to be kept.
+    :param embeddings:  Embeddings tensor, (num_embeddings, out_size).
+    :return:            int8 NumPy array, (num_embeddings, out_size).
+    """
+    embeddings = embeddings.float()
+    scales = 127 / embeddings.abs().amax(dim=1, keepdim=True).clamp_min(1e-12)
+    return torch.round(embeddings * scales).to(torch.int8).cpu().numpy()
+
+
+def top_k(distances, k):
+    """
+    Indices of the k smallest distances of each row, sorted by increasing distance.
+    The top-k is selected in linear time with argpartition and only those k candidates are sorted.
+    :param distances:   Distance matrix, (num_queries, num_candidates).
+    :param k:           Number of neighbors.
+    :return:            Indices of the nearest neighbors, (num_queries, k).
+    """
+    part = np.argpartition(distances, kth=k - 1, axis=1)[:, :k]
+    row_sort = np.take_along_axis(distances, part, axis=1).argsort(axis=1)
+    return np.take_along_axis(part, row_sort, axis=1)
+
+
+def extract_embeddings(images, texts, model, out_size=256, num_samples=10, batch_size=None):
+    """
+    Compute the embeddings of the test images and of their 5 captions.
+    :param images:      Image features, (N, input_size).
+    :param texts:       Aggregated text features, (N, 5, emb_size).
+    :param out_size:    Size of the embeddings returned by the model.
+    :param batch_size:  Number of images per forward pass (None to embed all the samples at once).
+    :return:            Image embeddings (num_samples, out_size) and text embeddings (num_samples * 5, out_size),
+                        as float16 tensors on the GPU.
+    """
+    images = images[:num_samples]
+    texts = texts[:num_samples]
+    batch_size = batch_size or len(images)
 
-
-def extract_embeddings(dataloader, model, out_size=256, model_id='', num_samples=10):
     model.to('cuda')
-    with torch.no_grad():
+    with torch.inference_mode():
         model.eval()
-        image_embeddings = np.zeros((num_samples, 1024))
-        text_embeddings = np.zeros((num_samples * 5, 1024))
-        k = 0
-        for images, texts in dataloader:
-            images = images[:num_samples, :]
-            texts = texts[:num_samples, :]
-            if cuda:
-                images = images.cuda()
-                texts = texts.cuda()
-            text_batch = texts.reshape(len(texts) * 5, 300)
-            im_emb, text_emb = model.get_embedding_pair(images, text_batch)
-            image_embeddings[k:k + len(images)] = im_emb.data.cpu().numpy()
-            text_embeddings[k:k + len(texts) * 5] = text_emb.data.cpu().numpy()
-            k += len(images)
+        # Keep the embeddings on the GPU, they are fed directly to the Faiss GPU index.
+        # Half precision is enough for retrieval and halves the memory traffic.
+        # Every row is written below, so the buffers are not zero-filled
+        image_embeddings = torch.empty((len(images), out_size), device='cuda', dtype=torch.float16)
+        text_embeddings = torch.empty((len(texts) * 5, out_size), device='cuda', dtype=torch.float16)
+        for k in range(0, len(images), batch_size):
+            # The features are stored in float16, they are cast to float32 once on the GPU
+            image_batch = images[k:k + batch_size].cuda().float()
+            text_batch = texts[k:k + batch_size].reshape(-1, texts.shape[-1]).cuda().float()
+            im_emb, text_emb = model.get_embedding_pair(image_batch, text_batch)
+            image_embeddings[k:k + len(image_batch)].copy_(im_emb)
+            text_embeddings[k * 5:k * 5 + len(text_batch)].copy_(text_emb)
 
     return image_embeddings, text_embeddings
 
 
-def main():
+def main(qualitative=True):
     # Load the datasets
     ROOT_PATH = "../../data/"
-    TEST_IMG_EMB = ROOT_PATH + "Flickr30k/test_FasterRCNN_features.pkl"
-    TEST_TEXT_EMB = ROOT_PATH + "Flickr30k/test_fasttext_features.pkl"
+    # float16 features generated with convert_features_to_npy.py
+    TEST_IMG_EMB = ROOT_PATH + "Flickr30k/test_FasterRCNN_features.f16.npy"
+    TEST_TEXT_EMB = ROOT_PATH + "Flickr30k/test_fasttext_mean_features.f16.npz"
 
     # Method selection
     base = 'TextToImage'
@@ -63,14 +114,13 @@ def main():
     model_id = base + '_' + image_features + '_' + text_aggregation + '_textagg_' + info
 
     PATH_MODEL = 'models/'
+    PATH_CACHE = 'cache/'
+    PATH_QUALITATIVE = 'qualitative/'
 
     # Load the test dataset
     test_dataset = Flickr30k(TEST_IMG_EMB, TEST_TEXT_EMB, train=False,
                              text_aggregation=text_aggregation)  # Create the test dataset
 
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=test_dataset.length_dataset, shuffle=False,
-                                              num_workers=1)
-
     margin = 1.
     embedding_text_net = EmbeddingTextNet(embedding_size=emb_size, output_size=out_size, sequence_modeling=None)
     embedding_image_net = EmbeddingImageNet(input_size=input_size, output_size=out_size)
@@ -98,76 +148,130 @@ def main():
             dict_sentences[count] = sentence['raw']
             count += 1
 
-    # Extract embeddings
-    image_embeddings, text_embeddings = extract_embeddings(test_loader, model, out_size, model_id, num_samples)
-
-    # Compute the labels for each embedding
-    image_labels = [i for i in range(1, len(data) + 1)]
-    text_labels = [j for j in range(1, len(data) + 1) for i in range(5)]  # Trick to obtain the same
+    # Extract embeddings, or load them from the cache if this model was already evaluated.
+    # The modification times of the checkpoint and of the test features are part of the key, so that retrained
+    # models and regenerated features are re-extracted. Untrained models (no checkpoint) are never cached
+    use_cache = path.exists(PATH_MODEL + model_id + '.pth')
+    if use_cache:
+        mtimes = [str(int(os.path.getmtime(file))) for file in (PATH_MODEL + model_id + '.pth', TEST_IMG_EMB,
+                                                                 TEST_TEXT_EMB)]
+        cache_path = PATH_CACHE + model_id + '_' + str(num_samples) + '_' + '_'.join(mtimes) + '.npz'
+    if use_cache and path.exists(cache_path):
+        print('Loading the embeddings from the cache, {}'.format(cache_path))
+        cache = np.load(cache_path)
+        image_embeddings = torch.from_numpy(cache['image']).cuda()
+        text_embeddings = torch.from_numpy(cache['text']).cuda()
+    else:
+        # The whole test set fits in memory, so the features are used directly as tensors (N, D) and (N, 5, D).
+        # Only the evaluated samples are read, and copied out of the read-only memory map
+        images = torch.from_numpy(np.array(test_dataset.image_embeddings[:, :num_samples].T, order='C'))
+        texts = torch.from_numpy(np.array(test_dataset.text_embeddings[:num_samples], order='C'))
+        # Embed the samples in fixed size chunks, so that the activations of the projection heads fit in memory
+        image_embeddings, text_embeddings = extract_embeddings(images, texts, model, out_size, num_samples,
+                                                               batch_size=256)
+        # Release the memory of the activations before the search
+        torch.cuda.empty_cache()
+        if use_cache:
+            if not path.exists(PATH_CACHE):
+                os.makedirs(PATH_CACHE)
+            np.savez(cache_path, image=image_embeddings.cpu().numpy(), text=text_embeddings.cpu().numpy())
+
+    # Compute the labels for each embedding, image i has label i + 1
+    text_labels = np.repeat(np.arange(1, len(data) + 1), 5)  # Trick to obtain the same
     # number of labels, copying the same labels 5 (5 text embeddings)
 
     # Compute the nearest neighbors
     print('Computing the nearest neighbors...')
     k = 5  # Number of nearest neighbors
 
-    index = faiss.IndexFlatL2(image_embeddings.shape[1])  # Build the index
-    # add the features of the train set to the index
-    index.add(np.float32(image_embeddings))
-    # retrieve the features of the test set
-    text_embeddings = np.float32(text_embeddings)
-    D, I = index.search(np.array(text_embeddings), k)
-
-    # knn = KNeighborsClassifier(n_neighbors=k, algorithm='auto', metric='euclidean').fit(image_embeddings, image_labels)
-    #
-    # # Make predictions
-    # distances, indices = knn.kneighbors(text_embeddings)
+    # For small test sets a SIMD brute-force on the CPU is cheaper than initializing the Faiss GPU resources
+    if len(image_embeddings) <= SIMSIMD_MAX_SAMPLES:
+        # Cosine distances between every text and every image, (5N, N), computed with int8 dot products
+        # on all the CPU cores (threads=0)
+        D = np.asarray(simsimd.cdist(quantize_int8(text_embeddings), quantize_int8(image_embeddings), metric='cos',
+                                     dtype='int8', threads=0))
+        I = top_k(D, k)
+    else:
+        # L2-normalize the embeddings so that the inner product is the cosine similarity
+        image_embeddings = torch.nn.functional.normalize(image_embeddings, dim=1)
+        text_embeddings = torch.nn.functional.normalize(text_embeddings, dim=1)
+
+        index = faiss.IndexFlatIP(image_embeddings.shape[1])  # Build the index
+        # Move the index to the GPU, the brute-force search becomes a batched GEMM
+        res = faiss.StandardGpuResources()
+        co = faiss.GpuClonerOptions()
+        co.useFloat16 = True  # Store the vectors in half precision on the GPU
+        index = faiss.index_cpu_to_gpu(res, 0, index, co)
+        # add the features of the train set to the index
+        index.add(image_embeddings.float())
+        # retrieve the features of the test set (all the queries in a single search call)
+        D, I = index.search(text_embeddings.float(), k)
+        I = I.cpu().numpy()
 
     # Compute mAPk
-    image_labels_pred = []
-
-    #
-    for k_predictions in I.tolist():
-        # map indices with the corresponding labels
-        k_labels_pred = [image_labels[i] for i in k_predictions]
-        image_labels_pred.append(k_labels_pred)
+    # map indices with the corresponding labels
+    image_labels_pred = (I + 1).tolist()
 
-    t_labels = [[i] for i in text_labels]  # Convert list of labels into list of list (for mapk function)
+    t_labels = text_labels.reshape(-1, 1).tolist()  # Convert labels into list of list (for mapk function)
     map_k = mapk(t_labels, image_labels_pred, k=k)
     print(f'mAP@{k}: {map_k}')
 
-    # Qualitative results
+    if not qualitative:
+        return
+
+    # Only needed for the qualitative results, the native libturbojpeg is not loaded otherwise
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    jpeg = TurboJPEG()
+
+    # Qualitative results, saved as a single image (one row per sample)
+    if not path.exists(PATH_QUALITATIVE):
+        os.makedirs(PATH_QUALITATIVE)
     num_samples = 20
     # Create random samples
     random_samples = np.random.choice(list(range(len(data) * 5)), num_samples, replace=False)
 
-    # im_labels, image_labels_pred
-    for sample in random_samples:
-        print("Example:" + str(sample))
-        print("--------------------------------")
-
-        print("Query text: " + dict_sentences[sample])
+    # Image filenames, in the same order as the image ids
+    filenames = list(gt.keys())
 
+    # Image paths of every sample: the ground truth image followed by the k predicted images
+    sample_paths = []
+    for sample in random_samples:
         # Obtain ground truth image, mapping the text sample to the image id
         gt_image_id = text_labels[sample]
         # Map the id to the image filename
-        gt_image_filename = list(gt)[gt_image_id - 1]
-        plt.figure(figsize=(15, 10))
-        # Plot the ground truth image
-        plt.subplot(1, k + 1, 1)
-        plt.imshow(plt.imread(ROOT_PATH + 'Flickr30k/flickr30k-images/' + gt_image_filename))
-
+        gt_image_filename = filenames[gt_image_id - 1]
         # Get predicted images from that text
         predictions = I[sample]
-        count = 1
-        for pred in predictions:
-            filename = list(gt)[pred]
-            plt.subplot(1, k + 1, count + 1)
-            plt.imshow(plt.imread(ROOT_PATH + 'Flickr30k/flickr30k-images/' + filename))
-            count += 1
-        plt.show()
+        sample_filenames = [gt_image_filename] + [filenames[pred] for pred in predictions]
+        sample_paths.append([ROOT_PATH + 'Flickr30k/flickr30k-images/' + filename for filename in sample_filenames])
+
+    # Read and decode all the images in parallel, then group them again by sample
+    with ThreadPoolExecutor() as executor:
+        images = list(executor.map(partial(read_image, jpeg=jpeg, pixel_format=TJPF_RGB),
+                                   [p for paths in sample_paths for p in paths]))
+    sample_images = [images[i:i + k + 1] for i in range(0, len(images), k + 1)]
+
+    fig, axes = plt.subplots(num_samples, k + 1, figsize=(3 * (k + 1), 3 * num_samples), squeeze=False)
+    # im_labels, image_labels_pred
+    for i, (sample, images) in enumerate(zip(random_samples, sample_images)):
+        print("Example:" + str(sample))
+        print("--------------------------------")
+
+        print("Query text: " + dict_sentences[sample])
+
+        # Plot the ground truth image (first column) followed by the predicted images
+        for j, image in enumerate(images):
+            axes[i, j].imshow(image)
+            axes[i, j].set_axis_off()
         print("--------------------------------------------------------------------------------")
+    fig.savefig(PATH_QUALITATIVE + 'qualitative.png', dpi=72)
+    plt.close(fig)
 
 
 # Main
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Evaluate the text to image retrieval')
+    parser.add_argument('--qualitative', action=argparse.BooleanOptionalAction, default=True,
+                        help='Save the qualitative results of 20 random queries in a single figure')
+    args = parser.parse_args()
+    main(qualitative=args.qualitative)
@@ -45,8 +45,9 @@ def main():
     ROOT_PATH = "../../data/"
     PATH_IMAGES = ROOT_PATH + "Flickr30k/flickr30k-images"
 
-    TRAIN_TEXT_EMB = ROOT_PATH + "Flickr30k/train_bert_features.pkl"
-    TEST_TEXT_EMB = ROOT_PATH + "Flickr30k/val_bert_features.pkl"
+    # Precomputed with task_d_BERT_extract_embeddings.py
+    TRAIN_TEXT_EMB = ROOT_PATH + "Flickr30k/train_bert_features.npy"
+    TEST_TEXT_EMB = ROOT_PATH + "Flickr30k/val_bert_features.npy"
 
     # Method selection
     base = 'TextToImage'
@@ -68,11 +69,14 @@ def main():
     test_dataset_triplet = TripletFlickr30kTextToImgEndToEnd(test_dataset, split='test')
 
     batch_size = 8
-    # kwargs = {'num_workers': 1, 'pin_memory': True} if cuda else {}
+    kwargs = {'num_workers': max(1, os.cpu_count() // 2), 'pin_memory': True, 'persistent_workers': True,
+              'prefetch_factor': 4} if cuda else {}
 
     # Create the dataloaders
-    triplet_train_loader = torch.utils.data.DataLoader(train_dataset_triplet, batch_size=batch_size, shuffle=True)
-    triplet_test_loader = torch.utils.data.DataLoader(test_dataset_triplet, batch_size=batch_size, shuffle=False)
+    triplet_train_loader = torch.utils.data.DataLoader(train_dataset_triplet, batch_size=batch_size, shuffle=True,
+                                                       **kwargs)
+    triplet_test_loader = torch.utils.data.DataLoader(test_dataset_triplet, batch_size=batch_size, shuffle=False,
+                                                      **kwargs)
 
     margin = 1.
     embedding_text_net = EmbeddingTextNet(embedding_size=emb_size, output_size=out_size, sequence_modeling=None)
@@ -86,6 +90,8 @@ def main():
     lr = 3e-4
     optimizer = optim.Adam(model.parameters(), lr=lr)
     scheduler = lr_scheduler.StepLR(optimizer, 8, gamma=0.1, last_epoch=-1)
+    # Mixed precision training
+    scaler = torch.amp.GradScaler('cuda') if cuda else None
     start_epoch = 0
     # Check if file exists
     if path.exists(OUTPUT_MODEL_DIR + model_id + '.pth'):
@@ -94,6 +100,8 @@ def main():
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer'])
         start_epoch = checkpoint['epoch']
+        if scaler is not None and checkpoint.get('scaler') is not None:
+            scaler.load_state_dict(checkpoint['scaler'])
 
     print('Starting training, EPOCH: ', start_epoch)
     n_epochs = 20
@@ -110,7 +118,7 @@ def main():
     }
 
     fit(triplet_train_loader, triplet_test_loader, model, loss_fn, optimizer, scheduler, n_epochs, cuda, log_interval,
-        model_id, start_epoch=start_epoch)
+        model_id, start_epoch=start_epoch, scaler=scaler)
 
 
 # main function
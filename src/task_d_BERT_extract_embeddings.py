@@ -37,26 +37,35 @@ class FlickrTextDataset(Dataset):
         return [self.sentences[idx]]
 
 
-def extractBertFeatures(dataloader):
-    sentences = []
-    for batch_idx, (data) in enumerate(dataloader):
-        # if batch_idx > 0:
-        #     break
-        print("batch_idx: ", batch_idx, "of ", len(dataloader))
-        bert_model.eval()
-        for sentence in data[0]:
-            inputs = bert_tokenizer(sentence, return_tensors="pt").to('cuda')
+def extractBertFeatures(dataset, batch_size=256):
+    """
+    Compute the BERT pooled output of every sentence of the dataset.
+    Sentences are sorted by number of tokens (smart batching), so that each batch is padded to a similar length.
+    :param dataset:     FlickrTextDataset.
+    :param batch_size:  Number of sentences per forward pass.
+    :return:            float32 array of features (num_sentences, hidden_size), in the order of the dataset.
+    """
+    sentences = dataset.sentences
+    order = np.argsort([len(bert_tokenizer.tokenize(sentence)) for sentence in sentences])
+
+    features = np.empty((len(sentences), bert_model.config.hidden_size), dtype=np.float32)
+    bert_model.eval()
+    with torch.inference_mode():
+        for start in tqdm(range(0, len(sentences), batch_size)):
+            batch_idx = order[start:start + batch_size]
+            inputs = bert_tokenizer([sentences[i] for i in batch_idx], padding=True, return_tensors="pt").to('cuda')
             out = bert_model(**inputs)
-            last_hidden_state = out.pooler_output
-            sentences.append(last_hidden_state.cpu().squeeze().detach().numpy())
-    return sentences
+            # Write the features back in the original order of the sentences
+            features[batch_idx] = out.pooler_output.cpu().numpy()
+    return features
 
 
 for split in ['train', 'val', 'test']:
     print("Processing split: ", split)
     dataset = FlickrTextDataset(split)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=256, shuffle=False)
-    bert_embeddings = np.asarray(extractBertFeatures(dataloader))
+    bert_embeddings = extractBertFeatures(dataset)
 
     with open(ROOT_PATH + 'Flickr30k/'+split+'_bert_features.pkl', 'wb') as f:
         pickle.dump(bert_embeddings, f)
+    # float16 copy, opened as a memory map by the datasets (see datasets.load_embeddings)
+    np.save(ROOT_PATH + 'Flickr30k/'+split+'_bert_features.npy', bert_embeddings.astype(np.float16))
@@ -5,7 +5,7 @@ import wandb
 
 def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs, cuda, log_interval, model_id,
         metrics=[],
-        start_epoch=0):
+        start_epoch=0, scaler=None):
     """
     Loaders, model, loss function and metrics should work together for a given task,
     i.e. The model should be able to process data output of loaders,
@@ -14,6 +14,8 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
     Examples: Classification: batch loader, classification model, NLL loss, accuracy metric
     Siamese network: Siamese loader, siamese model, contrastive loss
     Online triplet learning: batch loader, embedding model, online triplet loss
+
+    If a GradScaler is given, the forward pass is run with mixed precision (AMP)
     """
     for epoch in range(0, start_epoch):
         scheduler.step()
@@ -22,7 +24,8 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
         scheduler.step()
 
         # Train stage
-        train_loss, metrics = train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, metrics)
+        train_loss, metrics = train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, metrics,
+                                          scaler)
 
         message = 'Epoch: {}/{}. Train set: Average loss: {:.4f}'.format(epoch + 1, n_epochs, train_loss)
         for metric in metrics:
@@ -43,6 +46,7 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
             'model_state_dict': model.state_dict(),
             'optimizer': optimizer.state_dict(),
             'scheduler': scheduler.state_dict(),
+            'scaler': scaler.state_dict() if scaler is not None else None,
             'metrics': {metric.name(): metric.value() for metric in metrics},
             'val_loss': val_loss,
             'train_loss': train_loss,
@@ -55,7 +59,7 @@ def fit(train_loader, val_loader, model, loss_fn, optimizer, scheduler, n_epochs
         print(message)
 
 
-def train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, metrics):
+def train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, metrics, scaler=None):
     """
     Train for one epoch on the training set.
     :param train_loader:    Train data loader
@@ -65,6 +69,7 @@ def train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, met
     :param cuda:
     :param log_interval:
     :param metrics:
+    :param scaler:          GradScaler used for mixed precision training (None to train in FP32)
     :return:
     """
     for metric in metrics:
@@ -79,15 +84,18 @@ def train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, met
         if not type(data) in (tuple, list):
             data = (data,)
         if cuda:
-            data = tuple(d.cuda() for d in data)
+            data = tuple(d.cuda(non_blocking=True) for d in data)
             if target is not None:
-                target = target.cuda()
+                target = target.cuda(non_blocking=True)
 
         optimizer.zero_grad()
-        outputs = model(*data)
+        with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=scaler is not None):
+            outputs = model(*data)
 
         if type(outputs) not in (tuple, list):
             outputs = (outputs,)
+        # The loss is computed in FP32
+        outputs = tuple(output.float() for output in outputs)
 
         loss_inputs = outputs
         if target is not None:
@@ -98,8 +106,13 @@ def train_epoch(train_loader, model, loss_fn, optimizer, cuda, log_interval, met
         loss = loss_outputs[0] if type(loss_outputs) in (tuple, list) else loss_outputs
         losses.append(loss.item())
         total_loss += loss.item()
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         for metric in metrics:
             metric(outputs, target, loss_outputs)
@@ -129,9 +142,9 @@ def test_epoch(val_loader, model, loss_fn, cuda, metrics):
             if not type(data) in (tuple, list):
                 data = (data,)
             if cuda:
-                data = tuple(d.cuda() for d in data)
+                data = tuple(d.cuda(non_blocking=True) for d in data)
                 if target is not None:
-                    target = target.cuda()
+                    target = target.cuda(non_blocking=True)
 
             outputs = model(*data)
 